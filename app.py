@@ -3,35 +3,148 @@ from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
-import pandas as pd
-import requests
 import logging
-import json
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session
+import orjson
+import csv
+import io
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+from functools import partial
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, session
 from flask_cors import CORS
+from platformdirs import user_cache_dir
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
+from urllib3.util.retry import Retry
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
-from io import StringIO
 
 # Configure application
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "litmos-user-management-key")
 CORS(app)
 
+# Reject oversize uploads before Werkzeug buffers them
+app.config["MAX_CONTENT_LENGTH"] = 25 * 1024 * 1024
+
 # Litmos API configuration
 API_KEY = os.environ.get("LITMOS_API_KEY", "")
 BASE_URL = "https://api.litmos.com/v1.svc"
 SOURCE = "sourceapp"  # Required to avoid 401 error from Litmos API
-
-def get_headers():
-    return {
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "apikey": API_KEY
-    }
-
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+    "apikey": API_KEY
+}
+
+# Configure logging; an unknown LOG_LEVEL falls back to INFO rather than failing to boot
+LOG_LEVEL = (os.environ.get("LOG_LEVEL") or "INFO").upper()
+log_level = logging.getLevelName(LOG_LEVEL)
+valid_log_level = isinstance(log_level, int)
+logging.basicConfig(level=log_level if valid_log_level else logging.INFO)
 logger = logging.getLogger(__name__)
+if not valid_log_level:
+    logger.warning("Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL)
+
+# Litmos endpoint templates; path and query values must be URL-quoted
+USER_SEARCH_URL = BASE_URL + "/users?source=" + SOURCE + "&search={username}&format=json"
+USER_DETAILS_URL = BASE_URL + "/users/{user_id}?source=" + SOURCE + "&format=json"
+USER_TEAMS_URL = BASE_URL + "/users/{user_id}/teams?source=" + SOURCE + "&format=json"
+TEAM_USER_URL = BASE_URL + "/teams/{team_id}/users/{user_id}?source=" + SOURCE
+
+# Skip the per-user details GET when the search result already has every field we send back
+USE_SEARCH_PAYLOAD = True
+REQUIRED_USER_FIELDS = {"Id", "FirstName", "LastName", "Email", "UserName"}
+
+# Rows with an empty or over-long username are reported as failed without an API call
+MAX_USERNAME_LENGTH = 128
+
+# Number of users processed concurrently per CSV upload
+MAX_WORKERS = int(os.environ.get("LITMOS_MAX_WORKERS", "16"))
+# Number of team removals issued concurrently for one deactivated user
+TEAM_REMOVAL_WORKERS = 8
+# Upper bound on open connections to Litmos; extra requests wait for a free one
+POOL_SIZE = int(os.environ.get("LITMOS_POOL_SIZE", "32"))
+
+# On-disk HTTP cache. It holds user names and emails, so by default it lives in a
+# per-user cache directory that only the owner can read.
+CACHE_PATH = os.environ.get("LITMOS_CACHE_PATH")
+if not CACHE_PATH:
+    cache_dir = user_cache_dir("litmos-user-management")
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    os.chmod(cache_dir, 0o700)
+    CACHE_PATH = os.path.join(cache_dir, "litmos_cache")
+# Cached responses older than this are purged at startup and before each batch
+CACHE_RETENTION = timedelta(hours=24)
+
+# (connect, read) timeout in seconds for every Litmos call. Without one a stalled
+# socket blocks its worker forever and urllib3's connect/read retries never fire.
+REQUEST_TIMEOUT = (5, 30)
+
+class LitmosSession(CachedSession):
+    # Apply REQUEST_TIMEOUT to every request unless the caller passes its own
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+        return super().request(method, url, *args, **kwargs)
+
+# Shared session so all Litmos calls reuse pooled keep-alive connections.
+# Every GET is treated as stale immediately: responses with an ETag or
+# Last-Modified header are revalidated on each request (unchanged records come
+# back as bodiless 304s), and responses without validators are never served
+# from the cache, so status checks always see Litmos's current record.
+SESSION = LitmosSession(
+    CACHE_PATH,
+    backend="sqlite",
+    cache_control=True,
+    expire_after=0,
+    always_revalidate=True,
+    allowable_methods=("GET",)
+)
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=POOL_SIZE,
+    pool_block=True,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "PUT", "DELETE"],
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+))
+
+# Entries with validators are kept past expiry for revalidation, so purge old
+# ones explicitly to keep the cache file from growing without bound.
+def purge_expired_cache():
+    SESSION.cache.delete(older_than=CACHE_RETENTION)
+
+purge_expired_cache()
+
+# Batch results live server-side; the session cookie only carries a token.
+# Oldest batches are evicted once the store is full. The store is per process,
+# so the app must run as a single gunicorn worker (scale with --threads instead);
+# with several workers /results may be served by one that never saw the batch.
+RESULTS_STORE_MAX = 100
+RESULTS_STORE = OrderedDict()
+RESULTS_STORE_LOCK = threading.Lock()
+
+def store_results(results, token=None):
+    token = token or uuid.uuid4().hex
+    with RESULTS_STORE_LOCK:
+        RESULTS_STORE[token] = results
+        while len(RESULTS_STORE) > RESULTS_STORE_MAX:
+            RESULTS_STORE.popitem(last=False)
+    return token
+
+def load_results(token):
+    with RESULTS_STORE_LOCK:
+        return RESULTS_STORE.get(token, [])
 
 @app.route("/")
 def index():
@@ -47,49 +160,166 @@ def deactivation_page():
 
 @app.route("/results")
 def results_page():
-    results = session.get('results', [])
+    results = load_results(session.get('results_token'))
     operation_type = session.get('operation_type', 'Unknown')
     return render_template("results.html", results=results, operation_type=operation_type)
 
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    limit_mb = app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024)
+    return jsonify({"error": f"CSV file is too large. Maximum upload size is {limit_mb} MB."}), 413
+
+# Raised for uploads that should be rejected with a 400
+class UploadError(Exception):
+    pass
+
+# Validate the upload form and return (operation_type, worker, usernames, invalid).
+# usernames holds every CSV row in order; invalid maps row indexes to the reason
+# that row is skipped.
+def read_upload():
+    operation_type = request.form.get("operation_type")
+    if 'csv_file' not in request.files:
+        raise UploadError("No file part")
+
+    file = request.files['csv_file']
+    if file.filename == '':
+        raise UploadError("No selected file")
+
+    if file.filename and not file.filename.lower().endswith('.csv'):
+        raise UploadError("File must be CSV format")
+
+    # Parse straight from the upload stream rather than buffering a decoded copy
+    reader = csv.DictReader(io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline=''))
+
+    if 'username' not in (reader.fieldnames or []):
+        raise UploadError("CSV must contain a 'username' column")
+
+    usernames = []
+    invalid = {}
+    for index, row in enumerate(reader):
+        username = (row.get('username') or '').strip()
+        if not username:
+            invalid[index] = "Skipped: empty username"
+        elif len(username) > MAX_USERNAME_LENGTH:
+            invalid[index] = f"Skipped: username is longer than {MAX_USERNAME_LENGTH} characters"
+        usernames.append(username)
+
+    if invalid:
+        logger.info("Skipped %d CSV rows with invalid usernames", len(invalid))
+
+    if operation_type == "activation":
+        worker = activate_user
+    elif operation_type == "deactivation":
+        worker = deactivate_user
+    else:
+        raise UploadError("Invalid operation type")
+
+    return operation_type, worker, usernames, invalid
+
+# Parse the upload and register a new batch for this session. Returns
+# (batch, None), or (None, error_response) when the upload is rejected.
+# The batch's results list is stored up front, one entry per CSV row, with
+# skipped rows already filled in. Pending rows hold a placeholder until their
+# user is processed, so an interrupted batch still shows on /results.
+def start_batch():
+    try:
+        operation_type, worker, usernames, invalid = read_upload()
+    except UploadError as e:
+        return None, (jsonify({"error": str(e)}), 400)
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        logger.error("Error processing CSV: %s", e)
+        return None, (jsonify({"error": str(e)}), 500)
+
+    purge_expired_cache()
+
+    results = []
+    rows_by_user = {}
+    for index, username in enumerate(usernames):
+        if index in invalid:
+            results.append({"username": username, "success": False, "message": invalid[index]})
+        else:
+            results.append({"username": username, "success": False, "message": "Not processed: the batch did not finish"})
+            # Litmos usernames are case-insensitive, so rows differing only in case share one call
+            rows_by_user.setdefault(username.lower(), []).append(index)
+
+    session['results_token'] = store_results(results)
+    session['operation_type'] = "Activation" if operation_type == "activation" else "Deactivation"
+    return {"worker": worker, "results": results, "rows_by_user": rows_by_user, "skipped": len(invalid)}, None
+
+# Each user costs several blocking Litmos calls, so process each distinct
+# username once, in parallel, and yield results as they finish. Results are
+# written into the stored batch from a done-callback, so they are kept even if
+# the caller stops iterating early (e.g. a dropped stream).
+def run_batch(batch):
+    results = batch["results"]
+    rows_by_user = batch["rows_by_user"]
+
+    def record(future, key):
+        for index in rows_by_user[key]:
+            results[index] = {**future.result(), "username": results[index]["username"]}
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = []
+        for key, indexes in rows_by_user.items():
+            future = executor.submit(batch["worker"], results[indexes[0]]["username"])
+            future.add_done_callback(partial(record, key=key))
+            futures.append(future)
+        for future in as_completed(futures):
+            yield future.result()
+
 @app.route("/api/process-csv", methods=["POST"])
 def process_csv():
-    try:
-        operation_type = request.form.get("operation_type")
-        if 'csv_file' not in request.files:
-            return jsonify({"error": "No file part"}), 400
+    batch, error = start_batch()
+    if error:
+        return error
 
-        file = request.files['csv_file']
-        if file.filename == '':
-            return jsonify({"error": "No selected file"}), 400
+    for _ in run_batch(batch):
+        pass
+    return jsonify({"success": True, "results": batch["results"]})
 
-        if file.filename and not file.filename.lower().endswith('.csv'):
-            return jsonify({"error": "File must be CSV format"}), 400
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {orjson.dumps(data).decode()}\n\n"
 
-        csv_content = file.read().decode('utf-8')
-        df = pd.read_csv(StringIO(csv_content))
+@app.route("/api/process-csv-stream", methods=["POST"])
+def process_csv_stream():
+    # Same as process_csv, but each user's result is sent as a Server-Sent Event as soon as it finishes
+    batch, error = start_batch()
+    if error:
+        return error
 
-        if 'username' not in df.columns:
-            return jsonify({"error": "CSV must contain a 'username' column"}), 400
+    def generate():
+        yield sse_event({"total": len(batch["rows_by_user"]), "skipped": batch["skipped"]}, event="start")
+        for result in run_batch(batch):
+            yield sse_event(result)
+        yield sse_event({"success": True}, event="done")
 
-        usernames = df['username'].tolist()
-        results = []
+    return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
 
-        for username in usernames:
-            if operation_type == "activation":
-                result = activate_user(username)
-            elif operation_type == "deactivation":
-                result = deactivate_user(username)
-            else:
-                return jsonify({"error": "Invalid operation type"}), 400
-            results.append(result)
+def parse_json(response):
+    return orjson.loads(response.content)
 
-        session['results'] = results
-        session['operation_type'] = "Activation" if operation_type == "activation" else "Deactivation"
-        return jsonify({"success": True, "results": results})
+def find_user(users, username):
+    target = username.lower()
+    return next((u for u in users if (u.get("UserName") or "").lower() == target), None)
 
-    except Exception as e:
-        logger.error(f"Error processing CSV: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+# Search Litmos for a user and return (user, search_url, error_message).
+# search_url is returned so callers invalidate exactly the cached lookup.
+def lookup_user(username):
+    user_url = USER_SEARCH_URL.format(username=quote(username, safe=""))
+    response = SESSION.get(user_url)
+
+    if response.status_code != 200:
+        return None, user_url, f"Failed to find user: {response.text}"
+
+    user = find_user(parse_json(response), username)
+
+    if not user:
+        return None, user_url, "User not found"
+
+    return user, user_url, None
 
 def sanitize_user_data(user_data, active_status):
     allowed = ["Id", "FirstName", "LastName", "Email", "Active", "UserName"]
@@ -99,71 +329,67 @@ def sanitize_user_data(user_data, active_status):
 
 def activate_user(username):
     try:
-        user_url = f"{BASE_URL}/users?source={SOURCE}&search={username}&format=json"
-        response = requests.get(user_url, headers=get_headers())
+        user, user_url, error = lookup_user(username)
 
-        if response.status_code != 200:
-            return {"username": username, "success": False, "message": f"Failed to find user: {response.text}"}
-
-        users = response.json()
-        user = next((u for u in users if u.get("UserName", "").lower() == username.lower()), None)
-
-        if not user:
-            return {"username": username, "success": False, "message": "User not found"}
+        if error:
+            return {"username": username, "success": False, "message": error}
 
         user_id = user.get("Id")
 
         if user.get("Active", False):
             return {"username": username, "success": False, "message": "Error: User is already active. Duplicate activation attempt."}
 
-        details_url = f"{BASE_URL}/users/{user_id}?source={SOURCE}&format=json"
-        get_response = requests.get(details_url, headers=get_headers())
+        details_url = USER_DETAILS_URL.format(user_id=quote(str(user_id), safe=""))
 
-        if get_response.status_code != 200:
-            return {"username": username, "success": False, "message": f"Failed to get user details: {get_response.text}"}
+        if USE_SEARCH_PAYLOAD and REQUIRED_USER_FIELDS <= user.keys():
+            user_data = user
+        else:
+            get_response = SESSION.get(details_url)
 
-        user_data = get_response.json()
+            if get_response.status_code != 200:
+                return {"username": username, "success": False, "message": f"Failed to get user details: {get_response.text}"}
+
+            user_data = parse_json(get_response)
         update_data = sanitize_user_data(user_data, True)
 
-        logger.debug(f"Activation payload: {json.dumps(update_data)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Activation payload: %s", update_data)
 
-        update_response = requests.put(details_url, headers=get_headers(), data=json.dumps(update_data))
+        update_response = SESSION.put(details_url, data=orjson.dumps(update_data))
 
         if update_response.status_code in [200, 201, 204]:
+            SESSION.cache.delete(urls=[user_url, details_url])
             return {"username": username, "success": True, "message": "User activated successfully"}
         else:
             return {"username": username, "success": False, "message": f"Failed to activate user: {update_response.text}"}
 
     except Exception as e:
-        logger.error(f"Error activating user {username}: {str(e)}")
+        logger.error("Error activating user %s: %s", username, e)
         return {"username": username, "success": False, "message": f"Error: {str(e)}"}
 
 def deactivate_user(username):
     try:
-        user_url = f"{BASE_URL}/users?source={SOURCE}&search={username}&format=json"
-        response = requests.get(user_url, headers=get_headers())
-
-        if response.status_code != 200:
-            return {"username": username, "success": False, "message": f"Failed to find user: {response.text}"}
-
-        users = response.json()
-        user = next((u for u in users if u.get("UserName", "").lower() == username.lower()), None)
+        user, user_url, error = lookup_user(username)
 
-        if not user:
-            return {"username": username, "success": False, "message": "User not found"}
+        if error:
+            return {"username": username, "success": False, "message": error}
 
         user_id = user.get("Id")
 
         if not user.get("Active", True):
             return {"username": username, "success": False, "message": "Error: User is already inactive. Duplicate deactivation attempt."}
 
-        # Get full user details
-        details_url = f"{BASE_URL}/users/{user_id}?source={SOURCE}&format=json"
-        get_response = requests.get(details_url, headers=get_headers())
-        if get_response.status_code != 200:
-            return {"username": username, "success": False, "message": f"Failed to get user details: {get_response.text}"}
+        # Get full user details unless the search result already has them.
+        # Region/Area/Country are cleared below, so they are not needed here.
+        details_url = USER_DETAILS_URL.format(user_id=quote(str(user_id), safe=""))
+        if USE_SEARCH_PAYLOAD and REQUIRED_USER_FIELDS <= user.keys():
+            user_data = user
+        else:
+            get_response = SESSION.get(details_url)
+            if get_response.status_code != 200:
+                return {"username": username, "success": False, "message": f"Failed to get user details: {get_response.text}"}
 
-        user_data = get_response.json()
+            user_data = parse_json(get_response)
 
         # Deactivate user and clear custom fields
         update_data = sanitize_user_data(user_data, False)
@@ -171,25 +397,38 @@ def deactivate_user(username):
         update_data["Area"] = ""
         update_data["Country"] = ""
 
-        logger.debug(f"Deactivation payload: {json.dumps(update_data)}")
-        update_response = requests.put(details_url, headers=get_headers(), data=json.dumps(update_data))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Deactivation payload: %s", update_data)
+        update_response = SESSION.put(details_url, data=orjson.dumps(update_data))
 
         if update_response.status_code not in [200, 201, 204]:
             return {"username": username, "success": False, "message": f"Failed to deactivate user: {update_response.text}"}
 
+        SESSION.cache.delete(urls=[user_url, details_url])
+
         # Remove user from all teams
-        teams_url = f"{BASE_URL}/users/{user_id}/teams?source={SOURCE}&format=json"
-        teams_response = requests.get(teams_url, headers=get_headers())
+        teams_url = USER_TEAMS_URL.format(user_id=quote(str(user_id), safe=""))
+        teams_response = SESSION.get(teams_url)
         if teams_response.status_code == 200:
-            teams = teams_response.json()
-            for team in teams:
-                team_id = team.get("Id")
-                remove_url = f"{BASE_URL}/teams/{team_id}/users/{user_id}?source={SOURCE}"
-                remove_response = requests.delete(remove_url, headers=get_headers())
-                if remove_response.status_code not in [200, 204]:
-                    logger.warning(f"Failed to remove user {username} from team {team_id}: {remove_response.text}")
+            teams = parse_json(teams_response)
+            with ThreadPoolExecutor(max_workers=TEAM_REMOVAL_WORKERS) as executor:
+                futures = {}
+                for team in teams:
+                    team_id = team.get("Id")
+                    remove_url = TEAM_USER_URL.format(team_id=quote(str(team_id), safe=""), user_id=quote(str(user_id), safe=""))
+                    futures[executor.submit(SESSION.delete, remove_url)] = team_id
+                for future in as_completed(futures):
+                    team_id = futures[future]
+                    try:
+                        remove_response = future.result()
+                    except Exception as e:
+                        logger.warning("Failed to remove user %s from team %s: %s", username, team_id, e)
+                        continue
+                    if remove_response.status_code not in [200, 204]:
+                        logger.warning("Failed to remove user %s from team %s: %s", username, team_id, remove_response.text)
+            SESSION.cache.delete(urls=[teams_url])
         else:
-            logger.warning(f"Failed to retrieve teams for user {username}: {teams_response.text}")
+            logger.warning("Failed to retrieve teams for user %s: %s", username, teams_response.text)
 
         return {
             "username": username,
@@ -198,7 +437,7 @@ def deactivate_user(username):
         }
 
     except Exception as e:
-        logger.error(f"Error deactivating user {username}: {str(e)}")
+        logger.error("Error deactivating user %s: %s", username, e)
         return {"username": username, "success": False, "message": f"Error: {str(e)}"}
 
 if __name__ == "__main__":
@@ -1,8 +1,4 @@
-import logging
 from app import app
 
-# Configure logging for debugging
-logging.basicConfig(level=logging.DEBUG)
-
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -37,30 +37,20 @@ document.addEventListener('DOMContentLoaded', function() {
         formData.append('csv_file', file);
         formData.append('operation_type', 'deactivation');
         
-        // Send the request to the backend
-        fetch(`${getBackendUrl()}/api/process-csv`, {
-            method: 'POST',
-            body: formData
-        })
-        .then(response => {
-            if (!response.ok) {
-                return response.json().then(data => {
-                    throw new Error(data.error || 'An error occurred while processing the request.');
-                });
+        // Send the request to the backend and stream per-user progress
+        processCsvStream(formData, (processed, total, skipped) => {
+            let message = `Processed ${processed} of ${total} users...`;
+            if (skipped) {
+                message += ` (${skipped} invalid ${skipped === 1 ? 'row' : 'rows'} skipped)`;
             }
-            return response.json();
+            updateLoadingMessage(message);
         })
-        .then(data => {
+        .then(() => {
             // Hide loading spinner
             hideLoading();
             
-            if (data.success) {
-                // Redirect to results page
-                redirectToResults();
-            } else {
-                // Show error message
-                showError(data.error || 'An error occurred while processing the request.');
-            }
+            // Redirect to results page
+            redirectToResults();
         })
         .catch(error => {
             // Hide loading spinner
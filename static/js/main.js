@@ -16,6 +16,86 @@ function showLoading() {
 // Function to hide loading spinner
 function hideLoading() {
     document.getElementById('loadingSpinner').style.display = 'none';
+    updateLoadingMessage('Processing, please wait...');
+}
+
+// Function to update the text shown under the loading spinner
+function updateLoadingMessage(message) {
+    document.getElementById('loadingMessage').textContent = message;
+}
+
+// Function to upload a CSV and receive results as Server-Sent Events.
+// Calls onProgress(processed, total, skipped) after each user and resolves once the batch is done.
+// Skipped rows are listed as failed results on the results page.
+function processCsvStream(formData, onProgress) {
+    return fetch(`${getBackendUrl()}/api/process-csv-stream`, {
+        method: 'POST',
+        body: formData
+    })
+    .then(response => {
+        if (!response.ok) {
+            return response.json().then(data => {
+                throw new Error(data.error || 'An error occurred while processing the request.');
+            });
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let total = 0;
+        let processed = 0;
+        let skipped = 0;
+        let done = false;
+
+        // Handle one "event: ...\ndata: ..." block from the stream
+        function handleEvent(block) {
+            let eventType = 'message';
+            let data = '';
+            for (const line of block.split('\n')) {
+                if (line.startsWith('event: ')) {
+                    eventType = line.slice(7);
+                } else if (line.startsWith('data: ')) {
+                    data += line.slice(6);
+                }
+            }
+            if (!data) {
+                return;
+            }
+
+            const payload = JSON.parse(data);
+            if (eventType === 'start') {
+                total = payload.total;
+                skipped = payload.skipped;
+                onProgress(processed, total, skipped);
+            } else if (eventType === 'done') {
+                done = true;
+            } else {
+                processed++;
+                onProgress(processed, total, skipped);
+            }
+        }
+
+        function read() {
+            return reader.read().then(({ value, done: streamDone }) => {
+                if (streamDone) {
+                    if (!done) {
+                        throw new Error('The connection closed before processing finished.');
+                    }
+                    return;
+                }
+
+                buffer += decoder.decode(value, { stream: true });
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    handleEvent(buffer.slice(0, boundary));
+                    buffer = buffer.slice(boundary + 2);
+                }
+                return read();
+            });
+        }
+
+        return read();
+    });
 }
 
 // Function to display error messages